@@ -1,78 +1,201 @@
 import argparse
-import collections
-import datetime
+import codecs
+import concurrent.futures
 import email.utils
+import functools
+import html.parser
+import json
 import os.path
 import progress.bar
 import re
 import requests
+import shutil
 import sys
+import threading
 import time
 import urllib.parse
-from bs4 import BeautifulSoup
+import urllib3
 from enum import Enum
-from typing import List
+from typing import Iterator, List, Optional, Tuple
 
 argparser = argparse.ArgumentParser()
 argparser.add_argument('destdir', help='Destination directory')
 argparser.add_argument('--exclude', action='append', help='Exclude pattern', default=[])
 argparser.add_argument('--exclude-file', action='append', help='File containing list of exclude patterns', default=[])
+argparser.add_argument('--parallel', type=int, help='Number of parallel downloads', default=1)
 
 base_url = 'https://myrient.erista.me/files'
 
+def make_session() -> requests.Session:
+    session = requests.Session()
+    session.headers['Accept'] = '*/*'
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    # 429 is deliberately not in status_forcelist: download_file honours
+    # Retry-After itself, which transport-level retries would preempt
+    retry = requests.adapters.Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504])
+    adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 # Don't match paths with ..
 valid_path_re = re.compile(r'^((?!\.\./)[^/\\]+/)*(?!\.\./)[^/\\]+/?$')
 
-def list_dir(session: requests.Session, path: str) -> List[str]:
+class LinkParser(html.parser.HTMLParser):
+    """Extracts link anchors and their listing dates from Myrient's autoindex
+    tables as the HTML streams in."""
+
+    def __init__(self):
+        super().__init__()
+        self.entries = []
+        self.in_link_cell = False
+        self.in_date_cell = False
+        self.pending_name = None
+        self.date_text = ''
+
+    def flush_entry(self, date=None):
+        if self.pending_name is not None:
+            self.entries.append((self.pending_name, date))
+            self.pending_name = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'td':
+            self.in_link_cell = ('class', 'link') in attrs
+            self.in_date_cell = ('class', 'date') in attrs
+        elif tag == 'a' and self.in_link_cell:
+            href = dict(attrs).get('href')
+            if href:
+                name = urllib.parse.unquote(href)
+                if valid_path_re.match(name):
+                    self.flush_entry()
+                    self.pending_name = name
+
+    def handle_data(self, data):
+        if self.in_date_cell:
+            self.date_text += data
+
+    def handle_endtag(self, tag):
+        if tag == 'td':
+            if self.in_date_cell:
+                self.flush_entry(self.date_text.strip() or None)
+                self.date_text = ''
+            self.in_link_cell = False
+            self.in_date_cell = False
+
+    def close(self):
+        super().close()
+        self.flush_entry()
+
+def list_dir(session: requests.Session, path: str) -> List[Tuple[str, Optional[str]]]:
     request_url = base_url + urllib.parse.quote(path)
-    response = session.get(request_url)
+    response = session.get(request_url, stream=True)
     if response.status_code != 200:
         raise Exception(f'Failed to fetch {base_url}')
-    soup = BeautifulSoup(response.text, 'html.parser')
-    result = []
-    for td_tag in soup.find_all('td', class_='link'):
-        for a_tag in td_tag.find_all('a', recursive=False):
-            if a_tag.has_attr('href'):
-                name = urllib.parse.unquote(a_tag['href'])
-                if valid_path_re.match(name):
-                    result.append(name)
-    return result
-
-nothing_re = re.compile('$^')
-
-def get_file_list(session: requests.Session, root_dir_path='/', exclude_re=nothing_re) -> List[str]:
-    dir_queue = collections.deque([root_dir_path])
-    dirs_seen = set()
-    file_paths = []
-    while dir_queue:
-        dir_path = dir_queue.popleft()
-        print(dir_path)
-        for filename in list_dir(session, dir_path):
-            sub_path = dir_path + filename
-            if sub_path.endswith('/'):
-                if sub_path not in dirs_seen and not exclude_re.match(sub_path):
-                    dirs_seen.add(sub_path)
-                    dir_queue.append(sub_path)
-            elif not exclude_re.match(sub_path):
-                file_paths.append(sub_path)
-    file_paths.sort()
-    return file_paths
-
-def compile_exclude_patterns(patterns) -> re.Pattern:
+    parser = LinkParser()
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    for chunk in response.iter_content(chunk_size=65536):
+        parser.feed(decoder.decode(chunk))
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    return parser.entries
+
+class _TrieNode:
+    __slots__ = ('children', 'wildcards', 'terminal')
+
+    def __init__(self):
+        self.children = {}
+        self.wildcards = []
+        self.terminal = False
+
+class ExcludeMatcher:
+    """Matches paths against exclude patterns using a trie of path components.
+
+    A pattern matches a whole path or any of its ancestor directories; the *
+    wildcard matches within a single component. Literal components are a dict
+    lookup per path component rather than a regex alternation over every
+    pattern.
+    """
+
+    def __init__(self, patterns):
+        self.root = _TrieNode()
+        for pattern in patterns:
+            node = self.root
+            for component in pattern.strip('/').split('/'):
+                if '*' in component:
+                    component_re = re.compile(re.escape(component).replace(r'\*', '[^/]*'))
+                    for existing_re, child in node.wildcards:
+                        if existing_re.pattern == component_re.pattern:
+                            node = child
+                            break
+                    else:
+                        child = _TrieNode()
+                        node.wildcards.append((component_re, child))
+                        node = child
+                else:
+                    node = node.children.setdefault(component, _TrieNode())
+            node.terminal = True
+
+    def match(self, path: str) -> bool:
+        nodes = [self.root]
+        for component in path.lstrip('/').split('/'):
+            next_nodes = []
+            for node in nodes:
+                child = node.children.get(component)
+                if child is not None:
+                    next_nodes.append(child)
+                for component_re, child in node.wildcards:
+                    if component_re.fullmatch(component):
+                        next_nodes.append(child)
+            if not next_nodes:
+                return False
+            if any(node.terminal for node in next_nodes):
+                return True
+            nodes = next_nodes
+        return False
+
+match_nothing = ExcludeMatcher(())
+
+max_list_workers = 8
+
+def iter_file_paths(session: requests.Session, root_dir_path='/', exclude_re=match_nothing) -> Iterator[Tuple[str, Optional[str]]]:
+    """Walks the remote tree breadth-first, yielding (file path, listing date)
+    pairs as they are discovered."""
+    dirs_seen = {root_dir_path}
+    wave = [root_dir_path]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_list_workers) as executor:
+        while wave:
+            # List all directories at the current depth in parallel
+            listings = executor.map(lambda dir_path: list_dir(session, dir_path), wave)
+            next_wave = []
+            for dir_path, entries in zip(wave, listings):
+                with output_lock:
+                    print(dir_path)
+                for filename, date in sorted(entries):
+                    sub_path = dir_path + filename
+                    if sub_path.endswith('/'):
+                        if sub_path not in dirs_seen and not exclude_re.match(sub_path):
+                            dirs_seen.add(sub_path)
+                            next_wave.append(sub_path)
+                    elif not exclude_re.match(sub_path):
+                        yield sub_path, date
+            wave = next_wave
+
+@functools.lru_cache()
+def compile_exclude_patterns(patterns: tuple) -> ExcludeMatcher:
     if not patterns:
-        return nothing_re    
-    return re.compile('|'.join('^/' + re.escape(pattern).replace(r'\*', '[^/]*') + '(?:/.*)?$' for pattern in patterns))
+        return match_nothing
+    return ExcludeMatcher(patterns)
 
 exclude_file_ignore_line_re = re.compile(r'^\s*(?:#.*)?$')
 
-def get_exclude_re(args) -> re.Pattern:
+def get_exclude_matcher(args) -> ExcludeMatcher:
     excludes = list(args.exclude)
     for exclude_file in args.exclude_file:
         with open(exclude_file) as f:
             for line in f:
                 if not exclude_file_ignore_line_re.match(line):
                     excludes.append(line.rstrip())
-    return compile_exclude_patterns(excludes)
+    return compile_exclude_patterns(tuple(excludes))
 
 def format_size(size: int) -> str:
     if size < 1024:
@@ -87,64 +210,263 @@ class DownloadStatus(Enum):
     Skipped = 2
     Failed = 3
 
-def download_file(session: requests.Session, src_file_path: str, dest_dir: str) -> DownloadStatus:
+# Serialises status messages from concurrent download threads
+output_lock = threading.Lock()
+
+# Maps file path -> [size, mtime, listing date] of the last successful download
+manifest_file_name = '.myrient-sync-manifest.json'
+
+def load_manifest(dest_dir: str) -> dict:
+    try:
+        with open(os.path.join(dest_dir, manifest_file_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(dest_dir: str, manifest: dict):
+    manifest_path = os.path.join(dest_dir, manifest_file_name)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def matches_manifest(manifest: dict, src_file_path: str, dst_file_path: str, remote_date: Optional[str]) -> bool:
+    entry = manifest.get(src_file_path)
+    # Without the remote listing date we cannot prove the remote file is
+    # unchanged, so fall back to a conditional GET
+    if remote_date is None or entry is None or len(entry) < 3 or entry[2] != remote_date:
+        return False
+    if not os.path.exists(dst_file_path):
+        return False
+    stat = os.stat(dst_file_path)
+    return stat.st_size == entry[0] and int(stat.st_mtime) == int(entry[1])
+
+# Files at least this large are fetched as parallel range requests
+segment_min_size = 64 * 1024 * 1024
+num_segments = 4
+
+download_chunk_size = 1024 * 1024
+
+# Bytes to accumulate before draining buffered chunks in one writev
+write_batch_size = 4 * 1024 * 1024
+
+# Minimum seconds between progress bar redraws
+progress_interval = 0.1
+
+def write_chunks(fd: int, chunks: List[bytes]):
+    while chunks:
+        written = os.writev(fd, chunks)
+        while chunks and written >= len(chunks[0]):
+            written -= len(chunks[0])
+            del chunks[0]
+        if written:
+            chunks[0] = chunks[0][written:]
+
+def preallocate_file(tmp_file, size: int):
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(tmp_file.fileno(), 0, size)
+    else:
+        tmp_file.truncate(size)
+
+class ProgressWriter:
+    """File-like sink that batches chunk writes and throttles progress updates."""
+
+    def __init__(self, tmp_file, bar=None):
+        self.tmp_file = tmp_file
+        self.bar = bar
+        self.use_writev = hasattr(os, 'writev')
+        self.chunks = []
+        self.buffered = 0
+        self.bytes_written = 0
+        self.last_draw = 0.0
+
+    def write(self, chunk) -> int:
+        if self.use_writev:
+            # Accumulate chunks and drain them with a single syscall
+            self.chunks.append(chunk)
+            self.buffered += len(chunk)
+            if self.buffered >= write_batch_size:
+                write_chunks(self.tmp_file.fileno(), self.chunks)
+                self.buffered = 0
+        else:
+            # The unbuffered file may write fewer bytes than given
+            remaining = memoryview(chunk)
+            while remaining:
+                remaining = remaining[self.tmp_file.write(remaining):]
+        self.bytes_written += len(chunk)
+        if self.bar and time.monotonic() - self.last_draw >= progress_interval:
+            self.bar.goto(self.bytes_written)
+            self.last_draw = time.monotonic()
+        return len(chunk)
+
+    def flush(self):
+        if self.chunks:
+            write_chunks(self.tmp_file.fileno(), self.chunks)
+            self.buffered = 0
+        if self.bar:
+            self.bar.goto(self.bytes_written)
+
+def download_stream(response, tmp_file, bar=None):
+    # Copy straight from the socket-backed file object, skipping
+    # iter_content's Python-level generator
+    response.raw.decode_content = True
+    writer = ProgressWriter(tmp_file, bar)
+    shutil.copyfileobj(response.raw, writer, length=download_chunk_size)
+    writer.flush()
+
+def download_segments(session: requests.Session, request_url: str, fd: int, content_length: int, bar=None) -> bool:
+    segment_size = (content_length + num_segments - 1) // num_segments
+    progress_lock = threading.Lock()
+    bytes_downloaded = 0
+    last_draw = 0.0
+    def fetch_segment(offset):
+        nonlocal bytes_downloaded, last_draw
+        end = min(offset + segment_size, content_length) - 1
+        response = session.get(request_url, headers={'Range': f'bytes={offset}-{end}'}, stream=True)
+        if response.status_code != 206:
+            response.close()
+            return False
+        pos = offset
+        for chunk in response.iter_content(chunk_size=download_chunk_size):
+            os.pwrite(fd, chunk, pos)
+            pos += len(chunk)
+            with progress_lock:
+                bytes_downloaded += len(chunk)
+                if bar and time.monotonic() - last_draw >= progress_interval:
+                    bar.goto(bytes_downloaded)
+                    last_draw = time.monotonic()
+        return True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_segments) as executor:
+        return all(executor.map(fetch_segment, range(0, content_length, segment_size)))
+
+def finish_bar(bar):
+    if bar:
+        bar.finish()
+        # Clear progress bar from the terminal
+        sys.stdout.write('\x1B[A\x1B[2K\r')
+        sys.stdout.flush()
+
+def download_file(session: requests.Session, src_file_path: str, dest_dir: str, manifest=None, remote_date=None, show_progress=True) -> Tuple[DownloadStatus, Optional[int]]:
     dst_file_path = os.path.join(dest_dir, src_file_path.lstrip('/'))
+    if manifest is not None and matches_manifest(manifest, src_file_path, dst_file_path, remote_date):
+        # Local file is unchanged since the last sync; skip the network round trip
+        with output_lock:
+            print(f'Skipping {src_file_path}')
+        return DownloadStatus.Skipped, None
     os.makedirs(os.path.dirname(dst_file_path), exist_ok=True)
     headers = {}
     if os.path.exists(dst_file_path):
-        modified_date = datetime.datetime.fromtimestamp(os.path.getmtime(dst_file_path))
-        headers['If-Modified-Since'] = email.utils.format_datetime(modified_date)
+        headers['If-Modified-Since'] = email.utils.formatdate(os.path.getmtime(dst_file_path), usegmt=True)
     request_url = base_url + urllib.parse.quote(src_file_path)
     response = session.get(request_url, headers=headers, stream=True)
     if response.status_code == 200:
         content_length = int(response.headers.get('Content-Length', 0))
-        last_modified = email.utils.parsedate_to_datetime(response.headers['Last-Modified'])
-        print(f'Downloading {src_file_path} ({format_size(content_length)})')
+        # Last-Modified as raw epoch seconds; no datetime objects needed
+        last_modified = email.utils.mktime_tz(email.utils.parsedate_tz(response.headers['Last-Modified']))
+        with output_lock:
+            print(f'Downloading {src_file_path} ({format_size(content_length)})')
         tmp_file_path = dst_file_path + '.tmp'
+        bar = progress.bar.Bar(max=content_length, suffix='%(percent)d%%') if show_progress else None
+        # Segment workers write in place with pwrite, which not every platform has
+        use_segments = (hasattr(os, 'pwrite') and content_length >= segment_min_size
+                        and response.headers.get('Accept-Ranges') == 'bytes')
         # Stream file data to temporary file
-        with open(tmp_file_path, 'wb') as tmp_file:
-            bytes_downloaded = 0
-            with progress.bar.Bar(max=content_length, suffix='%(percent)d%%') as bar:
-                for chunk in response.iter_content(chunk_size=8192):
-                    tmp_file.write(chunk)
-                    bytes_downloaded += len(chunk)
-                    bar.goto(bytes_downloaded)
-        # Clear progress bar from the terminal
-        sys.stdout.write('\x1B[A\x1B[2K\r')
-        sys.stdout.flush()
+        # Unbuffered: chunks are already written whole, via writev where available
+        with open(tmp_file_path, 'wb', buffering=0) as tmp_file:
+            if use_segments:
+                response.close()
+                preallocate_file(tmp_file, content_length)
+                if not download_segments(session, request_url, tmp_file.fileno(), content_length, bar):
+                    # Server ignored the Range header; redo as a single stream
+                    tmp_file.seek(0)
+                    response = session.get(request_url, stream=True)
+                    if response.status_code != 200:
+                        finish_bar(bar)
+                        return DownloadStatus.Failed, response.status_code
+                    download_stream(response, tmp_file, bar)
+            else:
+                if content_length > 0:
+                    # Reserve the extents up front to avoid fragmentation
+                    preallocate_file(tmp_file, content_length)
+                download_stream(response, tmp_file, bar)
+        finish_bar(bar)
         # Set the modification time
-        os.utime(tmp_file_path, (os.path.getatime(tmp_file_path), last_modified.timestamp()))
+        os.utime(tmp_file_path, (last_modified, last_modified))
         # Rename the temporary file
         os.replace(tmp_file_path, dst_file_path)
-        return DownloadStatus.Success
+        if manifest is not None:
+            manifest[src_file_path] = [content_length, last_modified, remote_date]
+        return DownloadStatus.Success, response.status_code
     elif response.status_code == 304:
-        print(f'Skipping {src_file_path}')
-        return DownloadStatus.Skipped
+        if manifest is not None:
+            stat = os.stat(dst_file_path)
+            manifest[src_file_path] = [stat.st_size, stat.st_mtime, remote_date]
+        with output_lock:
+            print(f'Skipping {src_file_path}')
+        return DownloadStatus.Skipped, response.status_code
+    elif response.status_code == 429:
+        # Server asked us to slow down; wait before the retry
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            time.sleep(min(int(retry_after), 60))
+        return DownloadStatus.Failed, response.status_code
     else:
-        return DownloadStatus.Failed
+        return DownloadStatus.Failed, response.status_code
+
+def is_terminal_status(status_code: Optional[int]) -> bool:
+    # Client errors other than 429 will never succeed on retry
+    return status_code is not None and 400 <= status_code < 500 and status_code != 429
 
-def download_file_with_retry(session, src_file_path, dest_dir, num_retries=3, retry_delay=0.5) -> DownloadStatus:
+def download_file_with_retry(session, src_file_path, dest_dir, manifest=None, remote_date=None, show_progress=True, num_retries=3, retry_delay=0.5) -> DownloadStatus:
     for try_count in range(1, num_retries + 1):
-        status = download_file(session, src_file_path, dest_dir)
+        try:
+            status, status_code = download_file(session, src_file_path, dest_dir, manifest, remote_date, show_progress)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError):
+            # Reading response.raw directly raises urllib3 errors on
+            # mid-stream failures, bypassing requests' exception translation
+            status, status_code = DownloadStatus.Failed, None
         if status != DownloadStatus.Failed:
             return status
-        time.sleep(retry_delay)
-    print(f'Failed to download {src_file_path}')
+        if is_terminal_status(status_code):
+            break
+        if try_count < num_retries:
+            time.sleep(retry_delay * 2 ** (try_count - 1))
+    with output_lock:
+        print(f'Failed to download {src_file_path}')
     return DownloadStatus.Failed
 
 def main():
     try:
         args = argparser.parse_args()
-        exclude_re = get_exclude_re(args)
-        session = requests.Session()
-        session.headers['Accept'] = '*/*'
-        session.headers['Accept-Encoding'] = 'gzip, deflate'
-        file_paths = get_file_list(session, exclude_re=exclude_re)
+        exclude_re = get_exclude_matcher(args)
+        session = make_session()
+        os.makedirs(args.destdir, exist_ok=True)
+        manifest = load_manifest(args.destdir)
         download_count = 0
         skipped_count = 0
         failed_count = 0
-        for file_path in file_paths:
-            status = download_file_with_retry(session, file_path, args.destdir)
+        try:
+            file_paths = iter_file_paths(session, exclude_re=exclude_re)
+            if args.parallel > 1:
+                # Progress bars would interleave between threads, so only print per-file status lines
+                with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel) as executor:
+                    futures = []
+                    try:
+                        # Downloads start as soon as the crawl discovers each file
+                        for file_path, remote_date in file_paths:
+                            futures.append(executor.submit(download_file_with_retry, session, file_path,
+                                                           args.destdir, manifest, remote_date, False))
+                        statuses = [future.result() for future in concurrent.futures.as_completed(futures)]
+                    except KeyboardInterrupt:
+                        # Cancel queued downloads so shutdown only waits for in-flight ones
+                        for future in futures:
+                            future.cancel()
+                        raise
+            else:
+                statuses = [download_file_with_retry(session, file_path, args.destdir, manifest, remote_date)
+                            for file_path, remote_date in file_paths]
+        finally:
+            save_manifest(args.destdir, manifest)
+        for status in statuses:
             if status == DownloadStatus.Success:
                 download_count += 1
             elif status == DownloadStatus.Skipped: